@@ -133,7 +133,7 @@ class GetSimilarGenomes:
     max_number_of_similar_genomes: int = 100
     max_number_of_genomes_per_query: int = 3
 
-    def init(
+    def __init__(
         self,
         job_name: str,
         min_id: float,
@@ -57,3 +57,14 @@ BRAZILIAN_STATES_SIGLAS = [
     "SE",
     "TO",
 ]
+
+METADATA_QUERY_COLUMNS = [
+    "strain",
+    "country",
+    "division",
+    "pango_lineage",
+    "host",
+    "date",
+]
+
+SUBSAMPLING_GROUP_BY = ["pango_lineage", "year", "month"]
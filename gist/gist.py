@@ -4,16 +4,32 @@ from gist.util import (
     check_dir,
     check_file,
     check_mask_pos_file,
+    init_metadata_worker,
+    is_up_to_date,
+    open_metadata_dataset,
+    query_metadata,
+    write_stamp,
+    run_augur_filter,
+    write_metadata_parquet,
+    write_subsample,
 )
+from gist.constants import SUBSAMPLING_GROUP_BY
+import csv
 import sys
 import click
 import os
+import shutil
 import subprocess
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyfastx
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from Bio.Blast.Applications import NcbimakeblastdbCommandline
 from Bio.Blast.Applications import NcbiblastnCommandline
 from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 
 
 class GetSubSamplingByState:
@@ -51,185 +67,306 @@ class GetSubSamplingByState:
         self.valid_subsampling_schema = valid_subsampling_schema
         self.sanitize_sequences()
         self.sanitize_metadata()
+        self.load_metadata()
         self.get_global()
 
-    def _augur_index(self) -> None:
-        augur_index_cmd = f"augur index \
-                            --sequences {self.output_job_dir}/sequences_gisaid.fasta.gz \
-                            --output {self.output_job_dir}/sequence_index_gisaid.tsv.gz"
-        run_augur_index_cmd = subprocess.run(augur_index_cmd, shell=True)
+    def _augur_index(self) -> int:
+        augur_index_cmd = [
+            "augur",
+            "index",
+            "--sequences",
+            f"{self.output_job_dir}/sequences_gisaid.fasta.gz",
+            "--output",
+            f"{self.output_job_dir}/sequence_index_gisaid.tsv",
+        ]
+        run_augur_index_cmd = subprocess.run(augur_index_cmd)
+
+        return run_augur_index_cmd.returncode
 
     def sanitize_sequences(self) -> None:
         print("Sanitize and index sequences")
         if os.path.exists(self.output_job_dir) == False:
             print(f"Creating {self.output_job_dir}")
             os.mkdir(self.output_job_dir)
-        sanitize_sequences_cmd = f"python {self.ncov_dir_scripts}/sanitize_sequences.py \
-                                    --sequences {self.sequences} \
-                                    --strip-prefixes hCoV-19/ SARS-CoV-2/ \
-                                    --output {self.output_job_dir}/sequences_gisaid.fasta.gz"
-        run_sanitize_sequences_cmd = subprocess.run(sanitize_sequences_cmd, shell=True)
-        self._augur_index()
+        stamp_file = os.path.join(self.output_job_dir, ".sanitize_sequences.stamp")
+        sanitized_sequences = f"{self.output_job_dir}/sequences_gisaid.fasta.gz"
+        outputs = [
+            sanitized_sequences,
+            f"{self.output_job_dir}/sequence_index_gisaid.tsv",
+        ]
+        if is_up_to_date(stamp_file, self.sequences, outputs):
+            print("Sanitized sequences are up to date, skipping")
+            return
+        if os.path.exists(stamp_file):
+            os.remove(stamp_file)
+        sanitize_sequences_cmd = [
+            sys.executable,
+            f"{self.ncov_dir_scripts}/sanitize_sequences.py",
+            "--sequences",
+            self.sequences,
+            "--strip-prefixes",
+            "hCoV-19/",
+            "SARS-CoV-2/",
+            "--output",
+        ]
+        if shutil.which("pigz"):
+            with open(sanitized_sequences, "wb") as output_handle:
+                run_sanitize_sequences_cmd = subprocess.Popen(
+                    sanitize_sequences_cmd + ["/dev/stdout"], stdout=subprocess.PIPE
+                )
+                run_pigz_cmd = subprocess.Popen(
+                    ["pigz", "-p", str(self.threads)],
+                    stdin=run_sanitize_sequences_cmd.stdout,
+                    stdout=output_handle,
+                )
+                run_sanitize_sequences_cmd.stdout.close()
+                run_pigz_cmd.wait()
+                run_sanitize_sequences_cmd.wait()
+            sanitized = (
+                run_sanitize_sequences_cmd.returncode == 0
+                and run_pigz_cmd.returncode == 0
+            )
+        else:
+            run_sanitize_sequences_cmd = subprocess.run(
+                sanitize_sequences_cmd + [sanitized_sequences]
+            )
+            sanitized = run_sanitize_sequences_cmd.returncode == 0
+        if sanitized and self._augur_index() == 0:
+            write_stamp(stamp_file, self.sequences)
 
     def sanitize_metadata(self) -> None:
         print("Sanitize metadata")
-        sanitize_metadata_cmd = f"python {self.ncov_dir_scripts}/sanitize_metadata.py \
-                                    --metadata {self.metadata} \
-                                    --metadata-id-columns strain name 'Virus name' \
-                                    --database-id-columns 'Accession ID' gisaid_epi_isl genbank_accession \
-                                    --parse-location-field Location \
-                                    --rename-fields 'Virus name=strain' Type=type 'Accession ID=gisaid_epi_isl' 'Collection date=date' 'Sequence length=length' Host=host 'Pango lineage=pango_lineage' 'Host=host'\
-                                    --strip-prefixes hCoV-19/ SARS-CoV-2/ \
-                                    --output {self.output_job_dir}/metadata_gisaid.tsv.gz"
-        run_sanitize_metadata_cmd = subprocess.run(sanitize_metadata_cmd, shell=True)
-
-    def _filter_state(self, state: object) -> str:
-        print(f"filter {state.name} genomes")
-        output = os.path.join(self.output_job_dir, f"state_{state.sigla}_sub.txt")
-        filter_by_state_cmd = f"""augur filter \
-                                --metadata {self.output_job_dir}/metadata_gisaid.tsv.gz \
-                                --sequence-index {self.output_job_dir}/sequence_index_gisaid.tsv.gz \
-                                --min-date {self.valid_subsampling_schema.min_date} \
-                                --max-date {self.valid_subsampling_schema.max_date} \
-                                --min-length {str(self.valid_subsampling_schema.min_genome_len)} \
-                                --query "(country == 'Brazil') & (division == '{state.name}') & (pango_lineage == {self.valid_subsampling_schema.target_lineages}) & (host == 'Human') " \
-                                --subsample-max-sequences {str(state.max_genomes)} \
-                                --exclude-ambiguous-dates-by any \
-                                --group-by pango_lineage year month \
-                                --output-strains {output}"""
-        run_filter_by_state_cmd = subprocess.run(filter_by_state_cmd, shell=True)
+        stamp_file = os.path.join(self.output_job_dir, ".sanitize_metadata.stamp")
+        outputs = [f"{self.output_job_dir}/metadata_gisaid.tsv"]
+        if is_up_to_date(stamp_file, self.metadata, outputs):
+            print("Sanitized metadata is up to date, skipping")
+            return
+        if os.path.exists(stamp_file):
+            os.remove(stamp_file)
+        sanitize_metadata_cmd = [
+            sys.executable,
+            f"{self.ncov_dir_scripts}/sanitize_metadata.py",
+            "--metadata",
+            self.metadata,
+            "--metadata-id-columns",
+            "strain",
+            "name",
+            "Virus name",
+            "--database-id-columns",
+            "Accession ID",
+            "gisaid_epi_isl",
+            "genbank_accession",
+            "--parse-location-field",
+            "Location",
+            "--rename-fields",
+            "Virus name=strain",
+            "Type=type",
+            "Accession ID=gisaid_epi_isl",
+            "Collection date=date",
+            "Sequence length=length",
+            "Host=host",
+            "Pango lineage=pango_lineage",
+            "Host=host",
+            "--strip-prefixes",
+            "hCoV-19/",
+            "SARS-CoV-2/",
+            "--output",
+            f"{self.output_job_dir}/metadata_gisaid.tsv",
+        ]
+        run_sanitize_metadata_cmd = subprocess.run(sanitize_metadata_cmd)
+        if run_sanitize_metadata_cmd.returncode == 0:
+            write_stamp(stamp_file, self.metadata)
+
+    def _input_args(self) -> list:
+        return [
+            "--metadata",
+            f"{self.output_job_dir}/metadata_gisaid.tsv",
+            "--sequence-index",
+            f"{self.output_job_dir}/sequence_index_gisaid.tsv",
+        ]
 
-        return output
+    def load_metadata(self) -> None:
+        print("Load metadata")
+        self.metadata_parquet = f"{self.output_job_dir}/metadata_gisaid.parquet"
+        write_metadata_parquet(
+            f"{self.output_job_dir}/metadata_gisaid.tsv",
+            f"{self.output_job_dir}/sequence_index_gisaid.tsv",
+            self.metadata_parquet,
+        )
+        self.metadata_dataset = open_metadata_dataset(self.metadata_parquet)
 
-    def _filter_country(self, country: object) -> str:
-        print(f"filter {country.name} genomes")
-        output = os.path.join(self.output_job_dir, f"country_{country.sigla}_sub.txt")
-        filter_by_country_cmd = f"""augur filter \
-                                --metadata {self.output_job_dir}/metadata_gisaid.tsv.gz \
-                                --sequence-index {self.output_job_dir}/sequence_index_gisaid.tsv.gz \
-                                --min-date {self.valid_subsampling_schema.min_date} \
-                                --max-date {self.valid_subsampling_schema.max_date} \
-                                --min-length {str(self.valid_subsampling_schema.min_genome_len)} \
-                                --query "(country == '{country.name}') & (pango_lineage == {self.valid_subsampling_schema.target_lineages}) & (host == 'Human')" \
-                                --subsample-max-sequences {str(country.max_genomes)} \
-                                --exclude-ambiguous-dates-by any \
-                                --group-by pango_lineage year month \
-                                --output-strains {output}"""
-        run_filter_by_country_cmd = subprocess.run(filter_by_country_cmd, shell=True)
+    def _length_expression(self) -> ds.Expression:
+        return ds.field("ACGT") >= self.valid_subsampling_schema.min_genome_len
 
-        return output
+    def _date_expression(self, min_date: str, max_date: str) -> ds.Expression:
+        date_expression = ds.field("date") >= min_date if min_date else ds.scalar(True)
+        if max_date:
+            date_expression &= ds.field("date") <= max_date
+
+        return date_expression
+
+    def _split_buckets(
+        self, expression: ds.Expression, column: str, places: list, output_prefix: str
+    ) -> dict:
+        buckets = {}
+        for place in places:
+            print(f"filter {place.name} genomes")
+            output = os.path.join(
+                self.output_job_dir, f"{output_prefix}_{place.sigla}_sub.txt"
+            )
+            buckets[place.sigla] = (
+                expression & (ds.field(column) == place.name),
+                place.max_genomes,
+                output,
+            )
+
+        return buckets
 
-    def _filter_outgroup(self) -> str:
+    def _filter_states(self) -> dict:
+        expression = (
+            (ds.field("country") == "Brazil")
+            & ds.field("pango_lineage").isin(self.valid_subsampling_schema.target_lineages)
+            & (ds.field("host") == "Human")
+            & self._date_expression(
+                self.valid_subsampling_schema.min_date,
+                self.valid_subsampling_schema.max_date,
+            )
+            & self._length_expression()
+        )
+
+        return self._split_buckets(
+            expression, "division", self.valid_subsampling_schema.states, "state"
+        )
+
+    def _filter_countries(self) -> list:
+        expression = (
+            ds.field("pango_lineage").isin(self.valid_subsampling_schema.target_lineages)
+            & (ds.field("host") == "Human")
+            & self._date_expression(
+                self.valid_subsampling_schema.min_date,
+                self.valid_subsampling_schema.max_date,
+            )
+            & self._length_expression()
+        )
+
+        return list(
+            self._split_buckets(
+                expression, "country", self.valid_subsampling_schema.countries, "country"
+            ).values()
+        )
+
+    def _filter_outgroup(self) -> tuple:
         print(f"filter outgroup genomes")
         output = os.path.join(self.output_job_dir, "outgroup_sub.txt")
-        filter_outgroup_cmd = f"""augur filter \
-                                --metadata {self.output_job_dir}/metadata_gisaid.tsv.gz \
-                                --sequence-index {self.output_job_dir}/sequence_index_gisaid.tsv.gz \
-                                --max-date {self.valid_subsampling_schema.min_date} \
-                                --min-length {str(self.valid_subsampling_schema.min_genome_len)} \
-                                --query "pango_lineage == {self.valid_subsampling_schema.outgroup_lineages} & (host == 'Human')" \
-                                --subsample-max-sequences 30 \
-                                --exclude-ambiguous-dates-by any \
-                                --group-by pango_lineage year month \
-                                --output-strains {output}"""
-        run_filter_outgroup_cmd = subprocess.run(filter_outgroup_cmd, shell=True)
+        expression = (
+            ds.field("pango_lineage").isin(self.valid_subsampling_schema.outgroup_lineages)
+            & (ds.field("host") == "Human")
+            & self._date_expression(None, self.valid_subsampling_schema.min_date)
+            & self._length_expression()
+        )
 
-        return output
+        return expression, 30, output
 
     def _filter_gisaid(self) -> str:
         print(f"filter gisaid")
         subsampling_files = self.get_samples()
         output = os.path.join(self.output_job_dir, f"gisaid_sub.txt")
-        filter_gisaid_cmd = f"""augur filter \
-                                --metadata {self.output_job_dir}/metadata_gisaid.tsv.gz \
-                                --sequence-index {self.output_job_dir}/sequence_index_gisaid.tsv.gz \
-                                --min-date {self.valid_subsampling_schema.min_date} \
-                                --max-date {self.valid_subsampling_schema.max_date} \
-                                --min-length {str(self.valid_subsampling_schema.min_genome_len)} \
-                                --exclude {subsampling_files} \
-                                --query "(country != 'Brazil') & (pango_lineage == {self.valid_subsampling_schema.target_lineages}) & (host == 'Human') " \
-                                --exclude-ambiguous-dates-by any \
-                                --output-strains {output}"""
-
-        run_filter_gisaid_cmd = subprocess.run(filter_gisaid_cmd, shell=True)
+        subsampled_strains = []
+        for subsampling_file in subsampling_files:
+            with open(subsampling_file, "r") as file_reader:
+                subsampled_strains += file_reader.read().split()
+        metadata = query_metadata(
+            self.metadata_dataset,
+            (ds.field("country").is_null() | (ds.field("country") != "Brazil"))
+            & ds.field("pango_lineage").isin(self.valid_subsampling_schema.target_lineages)
+            & (ds.field("host") == "Human")
+            & self._date_expression(
+                self.valid_subsampling_schema.min_date,
+                self.valid_subsampling_schema.max_date,
+            )
+            & ~ds.field("strain").isin(pa.array(subsampled_strains, type=pa.string()))
+            & self._length_expression(),
+        )
+        with open(output, "w") as output_handle:
+            output_handle.writelines(f"{strain}\n" for strain in metadata.index)
 
         return output
 
-    def get_samples(self) -> str:
+    def _include_strains(self, include_files: list, output_prefix: str) -> None:
+        include_files = [
+            include_file
+            for include_file in include_files
+            if os.path.getsize(include_file) > 0
+        ]
+        if not include_files:
+            print(f"No strains selected for {output_prefix}, skipping")
+            return
+        include_file = os.path.join(self.output_job_dir, f"{output_prefix}_include.txt")
+        with open(include_file, "w") as output_handle:
+            for subsampling_file in include_files:
+                with open(subsampling_file, "r") as handle:
+                    shutil.copyfileobj(handle, output_handle)
+        run_augur_filter(
+            self._input_args()
+            + [
+                "--sequences",
+                f"{self.output_job_dir}/sequences_gisaid.fasta.gz",
+                "--exclude-all",
+                "--include",
+                include_file,
+                "--output-metadata",
+                f"{self.output_job_dir}/{output_prefix}_metadata_gisaid.tsv",
+                "--output-sequences",
+                f"{self.output_job_dir}/{output_prefix}_sequences_gisaid.fasta",
+            ]
+        )
+
+    def get_samples(self) -> list:
         sub_sampling_target_states = []
         sub_sampling_files = []
 
-        with ThreadPoolExecutor(max_workers=self.threads) as executor:
-            job_pool = []
-            for state in self.valid_subsampling_schema.states:
-                job = executor.submit(self._filter_state, state)
-                job.state_sigla = state.sigla
-                job_pool.append(job)
-
-            for job in job_pool:
-                subsampled_file = job.result()
-                if job.state_sigla in self.valid_subsampling_schema.target_states:
-                    sub_sampling_target_states.append(subsampled_file)
-                else:
-                    sub_sampling_files.append(subsampled_file)
+        target_states = set(self.valid_subsampling_schema.target_states or [])
+        buckets = []
+        for state_sigla, bucket in self._filter_states().items():
+            if state_sigla in target_states:
+                buckets.append((sub_sampling_target_states, bucket))
+            else:
+                buckets.append((sub_sampling_files, bucket))
 
         if self.valid_subsampling_schema.countries:
-            with ThreadPoolExecutor(max_workers=self.threads) as executor:
-                job_pool = []
-                for country in self.valid_subsampling_schema.countries:
-                    job = executor.submit(self._filter_country, country)
-                    job_pool.append(job)
-                for job in job_pool:
-                    subsampled_file = job.result()
-                    sub_sampling_files.append(subsampled_file)
-
-        sub_sampling_files.append(self._filter_outgroup())
-
-        if self.valid_subsampling_schema.target_states:
-            sub_sampling_target_states = " ".join(sub_sampling_target_states)
-        sub_sampling_files = " ".join(sub_sampling_files)
+            for bucket in self._filter_countries():
+                buckets.append((sub_sampling_files, bucket))
+
+        buckets.append((sub_sampling_files, self._filter_outgroup()))
+
+        with ProcessPoolExecutor(
+            max_workers=self.threads,
+            initializer=init_metadata_worker,
+            initargs=(self.metadata_parquet,),
+        ) as executor:
+            job_pool = {
+                executor.submit(
+                    write_subsample, *bucket, SUBSAMPLING_GROUP_BY
+                ): subsampled_files
+                for subsampled_files, bucket in buckets
+            }
+            for job in as_completed(job_pool):
+                subsampled_file = job.result()
+                if os.path.getsize(subsampled_file) == 0:
+                    continue
+                job_pool[job].append(subsampled_file)
 
         if self.valid_subsampling_schema.target_states:
-            get_samples_target_states_cmd = f"augur filter \
-                                --metadata {self.output_job_dir}/metadata_gisaid.tsv.gz \
-                                --sequence-index {self.output_job_dir}/sequence_index_gisaid.tsv.gz \
-                                --sequences {self.output_job_dir}/sequences_gisaid.fasta.gz \
-                                --exclude-all \
-                                --include {sub_sampling_target_states} \
-                                --output-metadata {self.output_job_dir}/subsampled_target_states_metadata_gisaid.tsv \
-                                --output-sequences {self.output_job_dir}/subsampled_target_states_sequences_gisaid.fasta"
-            run_get_samples_target_states_cmd = subprocess.run(
-                get_samples_target_states_cmd, shell=True
-            )
+            self._include_strains(sub_sampling_target_states, "subsampled_target_states")
 
-        get_samples_cmd = f"augur filter \
-                                --metadata {self.output_job_dir}/metadata_gisaid.tsv.gz \
-                                --sequence-index {self.output_job_dir}/sequence_index_gisaid.tsv.gz \
-                                --sequences {self.output_job_dir}/sequences_gisaid.fasta.gz \
-                                --exclude-all \
-                                --include {sub_sampling_files} \
-                                --output-metadata {self.output_job_dir}/subsampled_metadata_gisaid.tsv \
-                                --output-sequences {self.output_job_dir}/subsampled_sequences_gisaid.fasta"
-        run_get_samples_cmd = subprocess.run(get_samples_cmd, shell=True)
-
-        if self.valid_subsampling_schema.target_states:
-            return sub_sampling_target_states + " " + sub_sampling_files
+        self._include_strains(sub_sampling_files, "subsampled")
 
-        return sub_sampling_files
+        return sub_sampling_target_states + sub_sampling_files
 
     def get_global(self) -> None:
         print(f"creating gisaid base without sampling sequences")
         gisaid_samples = self._filter_gisaid()
-
-        filter_by_state_cmd = f"""augur filter \
-                                --metadata {self.output_job_dir}/metadata_gisaid.tsv.gz \
-                                --sequence-index {self.output_job_dir}/sequence_index_gisaid.tsv.gz \
-                                --sequences {self.output_job_dir}/sequences_gisaid.fasta.gz \
-                                --exclude-all \
-                                --include {gisaid_samples} \
-                                --output-metadata {self.output_job_dir}/gisaid_filtered_metadata_gisaid.tsv \
-                                --output-sequences {self.output_job_dir}/gisaid_filtered_sequences_gisaid.fasta"""
-        run_filter_by_state_cmd = subprocess.run(filter_by_state_cmd, shell=True)
+        self._include_strains([gisaid_samples], "gisaid_filtered")
 
 
 class GetSimilarGenomes:
@@ -273,47 +410,106 @@ class GetSimilarGenomes:
         self.get_gisaid_filtered_genomes()
 
     def create_blast_database(self) -> None:
+        if os.path.exists(f"{self.sequences}.nal"):
+            database_files = [f"{self.sequences}.nal"]
+        else:
+            database_files = [
+                f"{self.sequences}{extension}" for extension in (".nhr", ".nin", ".nsq")
+            ]
+        if all(os.path.exists(file) for file in database_files) and min(
+            os.path.getmtime(file) for file in database_files
+        ) >= os.path.getmtime(self.sequences):
+            print("BLAST database is up to date, skipping")
+            return
         make_db = NcbimakeblastdbCommandline(dbtype="nucl", input_file=self.sequences)
         stdout, stderr = make_db()
 
-    def perform_blast(self) -> None:
-        if os.path.exists(self.output_job_dir) == False:
-            print(f"Creating {self.output_job_dir}")
-            os.mkdir(self.output_job_dir)
-        output = os.path.join(self.output_job_dir, "gisaid_blastn.tsv")
+    def _split_query(self) -> list:
+        query_files = [
+            os.path.join(self.output_job_dir, f"query_{index}.fa")
+            for index in range(self.threads)
+        ]
+        query_handles = [open(query_file, "w") for query_file in query_files]
+        number_of_records = 0
+        with open(self.input_file, "r") as handle:
+            for title, sequence in SimpleFastaParser(handle):
+                query_handles[number_of_records % self.threads].write(
+                    f">{title}\n{sequence}\n"
+                )
+                number_of_records += 1
+        for query_handle in query_handles:
+            query_handle.close()
+        for query_file in query_files[number_of_records:]:
+            os.remove(query_file)
+
+        return query_files[:number_of_records]
+
+    def _blast_query(self, query_file: str) -> str:
+        output = f"{query_file}.tsv"
         blast = NcbiblastnCommandline(
-            query=self.input_file,
+            query=query_file,
             db=self.sequences,
             out=output,
             outfmt="6 qseqid sseqid pident evalue bitscore qcovhsp",
             task="megablast",
             evalue=0.00001,
-            num_threads=self.threads,
+            num_threads=1,
         )
         stdout, stderr = blast()
 
+        return output
+
+    def perform_blast(self) -> None:
+        if os.path.exists(self.output_job_dir) == False:
+            print(f"Creating {self.output_job_dir}")
+            os.mkdir(self.output_job_dir)
+        output = os.path.join(self.output_job_dir, "gisaid_blastn.tsv")
+        query_files = self._split_query()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            blast_outputs = list(executor.map(self._blast_query, query_files))
+
+        with open(output, "w") as output_handle:
+            for query_file, blast_output in zip(query_files, blast_outputs):
+                with open(blast_output, "r") as handle:
+                    shutil.copyfileobj(handle, output_handle)
+                os.remove(query_file)
+                os.remove(blast_output)
+
     def filter_blast_results(self) -> list:
         blast_results = os.path.join(self.output_job_dir, "gisaid_blastn.tsv")
         output = os.path.join(self.output_job_dir, "gisaid_blastn_filtered.tsv")
         blast_columns = ["qseqid", "sseqid", "pident", "evalue", "bitscore", "qcovhsp"]
-        blast_results_df = pd.read_csv(
-            blast_results, names=blast_columns, delimiter="\t"
-        )
-        blast_results_df = blast_results_df[blast_results_df["qcovhsp"] >= 99.9]
-        blast_results_df = blast_results_df[
-            (blast_results_df["pident"] >= self.valid_subsampling_schema.min_id)
-            & (blast_results_df["pident"] <= self.valid_subsampling_schema.max_id)
-        ]
-        blast_results_df = blast_results_df.sort_values(by="bitscore", ascending=False)
-        blast_results_df = blast_results_df.drop_duplicates(subset=["sseqid"])
-        blast_results_df = blast_results_df.groupby("qseqid").head(self.valid_subsampling_schema.max_number_of_genomes_per_query)
-        blast_results_df = blast_results_df.head(
-            self.valid_subsampling_schema.max_number_of_similar_genomes
-        )
-        gisaid_filtered_matches = blast_results_df["sseqid"].tolist()
-        blast_results_df.to_csv(output, sep="\t", index=False)
-
-        return gisaid_filtered_matches
+        schema = self.valid_subsampling_schema
+        with open(blast_results, "r") as handle:
+            blast_hits = [
+                hit
+                for hit in csv.reader(handle, delimiter="\t")
+                if float(hit[5]) >= 99.9
+                and schema.min_id <= float(hit[2]) <= schema.max_id
+            ]
+        blast_hits.sort(key=lambda hit: float(hit[4]), reverse=True)
+
+        selected_hits = []
+        seen_subjects = set()
+        hits_per_query = Counter()
+        for hit in blast_hits:
+            if len(selected_hits) == schema.max_number_of_similar_genomes:
+                break
+            qseqid, sseqid = hit[0], hit[1]
+            if sseqid in seen_subjects:
+                continue
+            seen_subjects.add(sseqid)
+            if hits_per_query[qseqid] == schema.max_number_of_genomes_per_query:
+                continue
+            hits_per_query[qseqid] += 1
+            selected_hits.append(hit)
+
+        with open(output, "w", newline="") as output_handle:
+            writer = csv.writer(output_handle, delimiter="\t")
+            writer.writerow(blast_columns)
+            writer.writerows(selected_hits)
+
+        return [hit[1] for hit in selected_hits]
 
     def get_gisaid_filtered_genomes(self):
         self.create_blast_database()
@@ -325,18 +521,24 @@ class GetSimilarGenomes:
         output_metadata = os.path.join(
             self.output_job_dir, "gisaid_similar_genomes.tsv"
         )
-        selected_records = []
-        with open(self.sequences, "r") as handle:
-            records = SeqIO.parse(handle, "fasta")
-            for record in records:
-                if record.id in gisaid_filtered_matches:
-                    selected_records.append(record)
+        sequences = pyfastx.Fasta(self.sequences)
         with open(output_sequences, "w") as output:
-            SeqIO.write(selected_records, output, "fasta")
+            output.writelines(
+                f">{sequences[match].description}\n{sequences[match].seq}\n"
+                for match in gisaid_filtered_matches
+            )
 
-        metadata_df = pd.read_csv(self.metadata, sep="\t")
-        selected_df = metadata_df[metadata_df["strain"].isin(gisaid_filtered_matches)]
-        selected_df.to_csv(output_metadata, sep="\t", index=False)
+        matches = set(gisaid_filtered_matches)
+        metadata_header = True
+        for metadata_chunk in pd.read_csv(self.metadata, sep="\t", chunksize=100_000):
+            metadata_chunk[metadata_chunk["strain"].isin(matches)].to_csv(
+                output_metadata,
+                sep="\t",
+                index=False,
+                header=metadata_header,
+                mode="w" if metadata_header else "a",
+            )
+            metadata_header = False
 
 
 class GetAlignment:
@@ -403,15 +605,23 @@ class GetAlignment:
     def perform_alignment(self):
         output = os.path.join(self.output_dir, f"sequences.algn.fa")
         renamed_alignment = os.path.join(self.output_dir, f"{os.path.basename(self.input_file)}.algn")
-        mafft_cmd = f"mafft --inputorder \
-                     --keeplength \
-                     --compactmapout \
-                     --anysymbol \
-                     --kimura 1 \
-                     --add {self.input_file} \
-                     --6merpair \
-                     --thread {self.threads} {self.reference} > {output}"
-        run_mafft_cmd = subprocess.run(mafft_cmd, shell=True)
+        mafft_cmd = [
+            "mafft",
+            "--inputorder",
+            "--keeplength",
+            "--compactmapout",
+            "--anysymbol",
+            "--kimura",
+            "1",
+            "--add",
+            self.input_file,
+            "--6merpair",
+            "--thread",
+            str(self.threads),
+            self.reference,
+        ]
+        with open(output, "w") as output_handle:
+            run_mafft_cmd = subprocess.run(mafft_cmd, stdout=output_handle)
         self.fix_sequence_names(output, renamed_alignment)
 
         if self.mask_pos:
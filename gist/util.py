@@ -1,6 +1,24 @@
+import argparse
+import hashlib
 import json
+import augur.filter
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+from augur.filter.subsample import (
+    calculate_sequences_per_group,
+    create_queues_by_group,
+    get_groups_for_subsampling,
+)
+from collections import Counter
 from dacite import from_dict
 from gist.config import SubSamplingStateLineage, GetSimilarGenomes
+from gist.constants import METADATA_QUERY_COLUMNS
 from gist.error import InvalidInput
 import os
 
@@ -47,3 +65,123 @@ def check_mask_pos_file(file: str) -> Exception:
                 raise InvalidInput(
                     f"{file} Start mask site should be lower than end mask site"
                 )
+
+
+def input_stamp(file: str) -> str:
+    return hashlib.sha1(
+        f"{os.path.getmtime(file)}:{os.path.getsize(file)}".encode()
+    ).hexdigest()
+
+
+def is_up_to_date(stamp_file: str, input_file: str, outputs: list) -> bool:
+    if not all(os.path.exists(output) for output in outputs + [stamp_file]):
+        return False
+    with open(stamp_file, "r") as file_reader:
+        return file_reader.read().strip() == input_stamp(input_file)
+
+
+def write_stamp(stamp_file: str, input_file: str) -> None:
+    with open(stamp_file, "w") as file_writer:
+        file_writer.write(input_stamp(input_file))
+
+
+def write_metadata_parquet(metadata: str, sequence_index: str, output: str) -> None:
+    parse_options = pacsv.ParseOptions(delimiter="\t")
+    metadata_table = pacsv.read_csv(
+        metadata,
+        parse_options=parse_options,
+        convert_options=pacsv.ConvertOptions(
+            include_columns=METADATA_QUERY_COLUMNS,
+            column_types={column: pa.string() for column in METADATA_QUERY_COLUMNS},
+        ),
+    )
+    unambiguous_date = pc.fill_null(
+        pc.match_substring_regex(metadata_table["date"], r"^\d{4}-\d{2}-\d{2}$"),
+        False,
+    )
+    metadata_table = metadata_table.filter(unambiguous_date)
+
+    sequence_index_table = pacsv.read_csv(
+        sequence_index,
+        parse_options=parse_options,
+        convert_options=pacsv.ConvertOptions(
+            include_columns=["strain", "A", "C", "G", "T"],
+            column_types={"strain": pa.string()},
+        ),
+    )
+    acgt = pc.add(
+        pc.add(sequence_index_table["A"], sequence_index_table["C"]),
+        pc.add(sequence_index_table["G"], sequence_index_table["T"]),
+    )
+    sequence_index_table = pa.table(
+        {"strain": sequence_index_table["strain"], "ACGT": acgt}
+    )
+
+    metadata_table = metadata_table.join(
+        sequence_index_table, "strain", join_type="inner"
+    ).sort_by([("country", "ascending"), ("division", "ascending")])
+    pq.write_table(
+        metadata_table, output, compression="zstd", row_group_size=200_000
+    )
+
+
+def run_augur_filter(filter_args: list) -> None:
+    parser = argparse.ArgumentParser(prog="augur filter")
+    augur.filter.register_arguments(parser)
+    augur.filter.run(parser.parse_args(filter_args))
+
+
+def subsample_strains(metadata: pd.DataFrame, group_by: list, max_sequences: int) -> list:
+    group_by_strain, skipped_strains = get_groups_for_subsampling(
+        metadata.index, metadata, group_by
+    )
+    records_per_group = Counter(group_by_strain.values())
+    if not records_per_group:
+        return []
+    sequences_per_group, probabilistic_used = calculate_sequences_per_group(
+        max_sequences, records_per_group.values()
+    )
+    queues_by_group = create_queues_by_group(
+        records_per_group.keys(), sequences_per_group
+    )
+    random_generator = np.random.default_rng()
+    for strain, group in group_by_strain.items():
+        queues_by_group[group].add(strain, random_generator.random())
+
+    return [
+        strain for queue in queues_by_group.values() for strain in queue.get_items()
+    ]
+
+
+def open_metadata_dataset(metadata_parquet: str) -> ds.Dataset:
+    return ds.dataset(metadata_parquet, filesystem=pafs.LocalFileSystem(use_mmap=True))
+
+
+def query_metadata(dataset: ds.Dataset, expression: ds.Expression) -> pd.DataFrame:
+    return (
+        dataset.to_table(
+            filter=expression,
+            columns=["strain", "country", "division", "pango_lineage", "date"],
+        )
+        .to_pandas()
+        .set_index("strain")
+    )
+
+
+_worker_metadata_dataset = None
+
+
+def init_metadata_worker(metadata_parquet: str) -> None:
+    global _worker_metadata_dataset
+    _worker_metadata_dataset = open_metadata_dataset(metadata_parquet)
+
+
+def write_subsample(
+    expression: ds.Expression, max_sequences: int, output: str, group_by: list
+) -> str:
+    metadata = query_metadata(_worker_metadata_dataset, expression)
+    strains = subsample_strains(metadata, group_by, max_sequences)
+    with open(output, "w") as output_handle:
+        output_handle.writelines(f"{strain}\n" for strain in strains)
+
+    return output